@@ -1,22 +1,153 @@
+import collections
+import concurrent.futures
 import dataclasses
+import functools
 import logging
-import pygments
-import pygments.formatters
-import pygments.lexers
 import sqlalchemy.ext.asyncio
-import sqlparse  # type: ignore[import-untyped]
 import sys
-import textwrap
+import weakref
+from collections.abc import MutableSequence
+from collections.abc import Sized
 from dataclasses import dataclass
 from types import TracebackType
+from typing import TYPE_CHECKING
 from typing import Any
+from typing import Callable
+from typing import Literal
 from typing import Self
 
+if TYPE_CHECKING:
+    import pygments.formatter
+    import pygments.lexer
+
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
+# Max number of messages to buffer before flushing when `CapSQL.flush` is off:
+_OUTPUT_BUFFER_SIZE = 16
+
+
+# Note: Pygments and sqlparse are imported lazily (on first use) since they're
+# relatively slow to import and aren't needed at all when neither pretty-printing nor
+# colorization is enabled.
+
+
+@functools.lru_cache(maxsize=1)
+def _get_sql_lexer() -> 'pygments.lexer.Lexer':
+    # Constructing a lexer compiles all of its token regexes, so only do it once.
+    import pygments.lexers  # pylint: disable=import-outside-toplevel
+
+    return pygments.lexers.SqlLexer()  # pylint: disable=no-member
+
+
+@functools.lru_cache(maxsize=1)
+def _get_terminal_formatter() -> 'pygments.formatter.Formatter':
+    import pygments.formatters  # pylint: disable=import-outside-toplevel
+
+    return pygments.formatters.TerminalFormatter()  # pylint: disable=no-member
+
+
+def _highlight(text: str) -> str:
+    import pygments  # pylint: disable=import-outside-toplevel
+
+    return pygments.highlight(
+        text,
+        _get_sql_lexer(),
+        _get_terminal_formatter(),
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _colorize(statement: str) -> str:
+    # Highlighting is relatively slow too, and statements repeat just as often.  Note:
+    # this should only be used for the SQL itself, not including params, since those
+    # would make nearly every key unique.
+    return _highlight(statement)
+
+
+@functools.lru_cache(maxsize=512)
+def _format_sql(statement: str) -> str:
+    # ORMs tend to execute the same statement text over and over (e.g. N+1 queries),
+    # and reindenting with sqlparse is comparatively expensive, so memoize it.
+    # pylint: disable-next=import-outside-toplevel
+    import sqlparse  # type: ignore[import-untyped]
+
+    return sqlparse.format(
+        statement,
+        reindent=True,
+        reindent_aligned=False,  # noop?
+    )
+
+
+def _looks_pretty(statement: str) -> bool:
+    """Cheaply guess whether a statement is already pretty-printed, e.g. because it
+    was written out by hand with :func:`sqlalchemy.text`, or has already been through
+    :func:`_format_sql`.
+
+    Note: SQLAlchemy's compiler emits multi-line statements too, but it leaves a
+    trailing space at the end of each line (``... \\nFROM ...``), which
+    :mod:`sqlparse` never does.
+    """
+    return (
+        '\n' in statement
+        and ' \n' not in statement
+        and statement.lstrip()[:6].isupper()
+    )
+
+
+def _get_params_size(parameters: Any) -> int:
+    return len(parameters) if isinstance(parameters, Sized) else 0
+
+
+@dataclass(frozen=True, slots=True)
+class _FormatOptions:
+    """A snapshot of the :class:`CapSQL` settings that determine how statements are
+    formatted, taken when entering the context.
 
-@dataclass
+    Captured statements are formatted lazily, so this keeps later changes to the
+    settings from affecting statements that were already captured.
+    """
+
+    pretty: bool
+    show_params: bool
+    max_format_bytes: int
+    max_params_repr: int
+
+    def format_sql(
+        self,
+        statement: str,
+    ) -> str:
+        if self.pretty and not _looks_pretty(statement):
+            if len(statement) <= self.max_format_bytes:
+                statement = _format_sql(statement)
+            else:
+                statement += (
+                    f'\n-- [capsql: skipped pretty-printing, {len(statement)} bytes]'
+                )
+        return statement
+
+    def format_params(
+        self,
+        parameters: Any,
+    ) -> str:
+        if not self.show_params:
+            params = ''
+        elif _get_params_size(parameters) <= self.max_params_repr:
+            params = f'\n-- params: {parameters!r}'
+        else:
+            params = f'\n-- params: <{len(parameters)} items truncated>'
+        return params
+
+    def format_statement(
+        self,
+        statement: str,
+        parameters: Any,
+    ) -> str:
+        # Note: join the pieces once, rather than repeatedly concatenating onto a
+        # (potentially large) statement string.
+        return ''.join((self.format_sql(statement), self.format_params(parameters)))
+
+
+@dataclass(slots=True, weakref_slot=True)
 class CapSQL:
     """A context manager that captures queries executed by a SQLAlchemy engine.
 
@@ -81,97 +212,281 @@ class CapSQL:
 
     show_params: bool = False
 
-    logger: logging.Logger = logger
+    max_params_repr: int = 1024
+    """With :attr:`show_params`, parameter collections larger than this are summarized
+    rather than dumped in full (e.g. for bulk inserts with thousands of rows).
+    """
+
+    logger: logging.Logger = dataclasses.field(default_factory=lambda: logger)
+    """The logger to use with :attr:`log`.
+
+    Statements are logged at ``INFO`` level, so the logger (or one of its ancestors)
+    needs to be configured to let ``INFO`` records through.
+    """
 
     pretty: bool = True
     """If set, pretty-print/format SQL statements using :mod:`sqlparse`."""
 
+    background: bool = False
+    """If set, format and echo/log statements in a background thread so that the
+    (comparatively slow) pretty-printing and colorization doesn't hold up query
+    execution.  Pending output is always written by the time the context exits.
+    """
+
+    flush: bool = True
+    """If set, echo/log each statement as soon as it executes; otherwise, buffer
+    output and emit it in batches (every few statements, and when exiting the
+    context) to cut down on the number of writes.
+    """
+
+    capture_elements: bool | Literal['weak'] = True
+    """If set, capture executed SQL element objects into :attr:`elements`.
+
+    If set to ``'weak'``, :attr:`elements` holds :class:`weakref.ref` objects rather
+    than the elements themselves, so that capturing doesn't keep every executed
+    element alive.  Note that elements constructed on the fly by SQLAlchemy (e.g.
+    ORM flushes) typically go away right after executing.
+    """
+
+    capture_statements: bool = True
+    """If set, capture executed SQL statements into :attr:`statements`."""
+
+    max_captured: int | None = None
+    """If set, only retain this many of the most recently captured elements and
+    statements, so that memory usage stays bounded during long capture sessions.
+    """
+
+    max_format_bytes: int = 65536
+    """Statements longer than this are left as-is rather than pretty-printed.
+
+    :mod:`sqlparse` reindenting scales very poorly with statement size (e.g. huge
+    ``IN (...)`` lists or bulk ``INSERT ... VALUES``), and can take seconds for a
+    single statement, so such statements are passed through with a marker comment.
+    """
+
     # Captured SQL:
-    elements: list[sqlalchemy.sql.Executable] = dataclasses.field(default_factory=list)
-    statements: list[str] = dataclasses.field(default_factory=list)
+    elements: MutableSequence[
+        sqlalchemy.sql.Executable | weakref.ref[sqlalchemy.sql.Executable]
+    ] = dataclasses.field(default_factory=list)
+    # Note: captured statements start out in `_pending_statements` as raw
+    # `(statement, parameters, format_options)` entries (with `parameters` only kept if
+    # `show_params` is set), and are moved into `_formatted_statements` once formatted.
+    _pending_statements: MutableSequence[tuple[str, Any, _FormatOptions]] = (
+        dataclasses.field(default_factory=list, init=False, repr=False)
+    )
+    _formatted_statements: MutableSequence[str] = dataclasses.field(
+        default_factory=list, init=False, repr=False
+    )
+    _text_cache: str | None = dataclasses.field(default=None, init=False, repr=False)
+    _output_buffer: list[str] = dataclasses.field(
+        default_factory=list, init=False, repr=False
+    )
+
+    # Settings that the event hooks depend on, precomputed in `__enter__`:
+    _needs_output: bool = dataclasses.field(default=False, init=False, repr=False)
+    _needs_color: bool = dataclasses.field(default=False, init=False, repr=False)
+    _format_options: _FormatOptions = dataclasses.field(
+        init=False, repr=False, compare=False
+    )
+
+    _executor: concurrent.futures.ThreadPoolExecutor | None = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    _background_error: BaseException | None = dataclasses.field(
+        default=None, init=False, repr=False
+    )
+    _listeners: list[tuple[str, Callable[..., None]]] = dataclasses.field(
+        default_factory=list, init=False, repr=False
+    )
+
+    # Bound `append` method of the statement list, looked up once in `__enter__` rather
+    # than on every event:
+    _append_statement: Callable[[tuple[str, Any, _FormatOptions]], None] = (
+        dataclasses.field(init=False, repr=False, compare=False)
+    )
+
+    def __post_init__(self) -> None:
+        if self.max_captured is not None:
+            self.elements = collections.deque(self.elements, maxlen=self.max_captured)
+            self._pending_statements = collections.deque(maxlen=self.max_captured)
+            self._formatted_statements = collections.deque(maxlen=self.max_captured)
 
     @property
-    def text(self) -> str:
-        return '\n\n'.join(self.statements)
+    def statements(self) -> list[str]:
+        """Captured SQL statements, formatted according to :attr:`pretty` and
+        :attr:`show_params` (as they were set when the statements were captured).
 
-    def clear(self) -> None:
-        self.elements = []
-        self.statements = []
+        Statements are captured raw and only formatted once they're actually needed
+        (i.e. when accessing this property, or when echoing/logging), so capturing
+        stays cheap for callers that never look at the statement text.
 
-    def _handle_before_execute(
-        self,
-        conn: sqlalchemy.engine.Connection,  # pylint: disable=unused-argument
-        clauseelement: sqlalchemy.sql.Executable,
-        multiparams: Any,  # pylint: disable=unused-argument
-        params: Any,  # pylint: disable=unused-argument
-        execution_options: dict[str, Any],  # pylint: disable=unused-argument
-    ) -> None:
-        self.elements.append(clauseelement)
+        A new list is returned on each access, so modifying it has no effect on the
+        captured statements; use :meth:`clear` instead.
+        """
+        self._format_pending()
+        return list(self._formatted_statements)
 
-    def _colorize(
-        self,
-        statement: str,
-    ) -> str:
-        return pygments.highlight(
-            statement,
-            pygments.lexers.SqlLexer(),  # pylint: disable=no-member
-            pygments.formatters.TerminalFormatter(),  # pylint: disable=no-member
-        )
+    @property
+    def text(self) -> str:
+        if self._text_cache is None:
+            self._format_pending()
+            self._text_cache = '\n\n'.join(self._formatted_statements)
+        return self._text_cache
+
+    def _format_pending(self) -> None:
+        """Format any newly captured statements, so that each statement only gets
+        formatted once no matter how often :attr:`statements`/:attr:`text` are read.
+        """
+        if self._pending_statements:
+            self._formatted_statements.extend(
+                format_options.format_statement(statement, parameters)
+                for statement, parameters, format_options in self._pending_statements
+            )
+            self._pending_statements.clear()
+
+    def clear(self) -> None:
+        self.elements.clear()
+        self._pending_statements.clear()
+        self._formatted_statements.clear()
+        self._text_cache = None
 
     def _output(
         self,
         message: str,
     ) -> None:
+        self._output_buffer.append(message)
+        if self.flush or len(self._output_buffer) >= _OUTPUT_BUFFER_SIZE:
+            self._flush_output()
+
+    def _flush_output(self) -> None:
+        if not self._output_buffer:
+            return
+        messages = self._output_buffer
+        self._output_buffer = []
+
         if self.echo:
-            print(message, file=sys.stderr)
+            sys.stderr.write(''.join(f'{message}\n' for message in messages))
 
-        if self.log:
+        if self.log and self.logger.isEnabledFor(logging.INFO):
             if self.pretty:
                 # TBD: when the SQL query/statement is formatted across multiple lines,
                 # indenting the log message tends to produce cleaner output - at least
                 # when using the standard pytest logging config, which prefixes the
                 # first line of log messages with `INFO ...`, which causes misalignment
                 # if we're not careful.
-                log_message = '\n' + textwrap.indent(message, '    ')
+                log_message = ''.join(
+                    '\n    ' + message.replace('\n', '\n    ') for message in messages
+                )
             else:
-                log_message = message
+                log_message = '\n'.join(messages)
             self.logger.info(log_message)
 
+    def _format_and_output(
+        self,
+        statement: str,
+        parameters: Any,
+    ) -> None:
+        format_options = self._format_options
+        sql = format_options.format_sql(statement)
+        params = format_options.format_params(parameters)
+        if self._needs_color and len(statement) <= format_options.max_format_bytes:
+            # Note: highlighting is skipped for huge statements, which would be slow and
+            # would pin lots of memory in the `_colorize` cache.  Params are highlighted
+            # separately since they'd just churn the cache.
+            message = _colorize(sql)
+            if params:
+                message += _highlight(params.lstrip('\n'))
+        else:
+            message = ''.join((sql, params))
+        self._output(message)
+
+    def _handle_output_done(
+        self,
+        future: concurrent.futures.Future[None],
+    ) -> None:
+        # Only the first error is kept (and later re-raised by `__exit__`), rather than
+        # holding onto every future for the lifetime of the context.
+        if self._background_error is None:
+            self._background_error = future.exception()
+
     def _handle_before_cursor_execute(
         self,
         conn: sqlalchemy.engine.Connection,  # pylint: disable=unused-argument
         cursor: sqlalchemy.engine.interfaces.DBAPICursor,  # pylint: disable=unused-argument
         statement: str,
         parameters: Any,
-        context: sqlalchemy.engine.ExecutionContext,  # pylint: disable=unused-argument
-        executemany: bool,  # pylint: disable=unused-argument
+        # Note: the remaining `context` and `executemany` arguments are unused, and
+        # just get packed into `_args` rather than each being bound to a local.
+        *_args: Any,
     ) -> None:
-        if self.pretty:
-            statement = sqlparse.format(
-                statement,
-                reindent=True,
-                reindent_aligned=False,  # noop?
+        if self.capture_statements:
+            format_options = self._format_options
+            self._append_statement(
+                (
+                    statement,
+                    parameters if format_options.show_params else None,
+                    format_options,
+                )
             )
-        if self.show_params:
-            statement += f'\n-- params: {parameters!r}'
-        self.statements.append(statement)
-        # TODO: capture params too?
+            self._text_cache = None
 
-        if self.echo or self.log:
-            self._output(self._colorize(statement) if self.color else statement)
+        # Note: when only logging, skip formatting altogether if the logger would drop
+        # the records anyway.  This is checked per statement (which is cheap, since
+        # `Logger.isEnabledFor` caches its result) so that level changes made while
+        # inside the context are still honored.
+        if self._needs_output and (self.echo or self.logger.isEnabledFor(logging.INFO)):
+            if self._executor is not None:
+                # Note: the executor has a single worker, so output stays in order.
+                self._executor.submit(
+                    self._format_and_output, statement, parameters
+                ).add_done_callback(self._handle_output_done)
+            else:
+                self._format_and_output(statement, parameters)
 
     def __enter__(self) -> Self:
         # TODO: gracefully deal with reentrancy
-        sqlalchemy.event.listen(
-            self.engine.sync_engine,
-            'before_execute',
-            self._handle_before_execute,
-        )
-        sqlalchemy.event.listen(
-            self.engine.sync_engine,
-            'before_cursor_execute',
-            self._handle_before_cursor_execute,
+        self._append_statement = self._pending_statements.append
+        self._format_options = _FormatOptions(
+            pretty=self.pretty,
+            show_params=self.show_params,
+            max_format_bytes=self.max_format_bytes,
+            max_params_repr=self.max_params_repr,
         )
+        self._needs_output = self.echo or self.log
+        self._needs_color = self.color and self._needs_output
+        if self.background and self._needs_output:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix='capsql'
+            )
+
+        # Only listen for the events that are actually needed, to avoid paying for an
+        # extra event dispatch on every statement:
+        self._listeners = []
+        # Note: `before_execute` is hit for every statement, so rather than going
+        # through a method, use a thin closure over the list's bound `append` method.
+        append_element = self.elements.append
+        if self.capture_elements == 'weak':
+            self._listeners.append(
+                (
+                    'before_execute',
+                    lambda conn, clauseelement, *args: append_element(
+                        weakref.ref(clauseelement)
+                    ),
+                )
+            )
+        elif self.capture_elements:
+            self._listeners.append(
+                (
+                    'before_execute',
+                    lambda conn, clauseelement, *args: append_element(clauseelement),
+                )
+            )
+        if self.capture_statements or self._needs_output:
+            self._listeners.append(
+                ('before_cursor_execute', self._handle_before_cursor_execute)
+            )
+        for identifier, listener in self._listeners:
+            sqlalchemy.event.listen(self.engine.sync_engine, identifier, listener)
         return self
 
     def __exit__(
@@ -180,16 +495,21 @@ class CapSQL:
         exc_value: BaseException | None,
         traceback: TracebackType | None,
     ) -> None:
-        sqlalchemy.event.remove(
-            self.engine.sync_engine,
-            'before_execute',
-            self._handle_before_execute,
-        )
-        sqlalchemy.event.remove(
-            self.engine.sync_engine,
-            'before_cursor_execute',
-            self._handle_before_cursor_execute,
-        )
+        for identifier, listener in self._listeners:
+            sqlalchemy.event.remove(self.engine.sync_engine, identifier, listener)
+        self._listeners = []
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        self._flush_output()
+
+        # Re-raise any error from the background thread, same as would've happened if
+        # formatting/output were done inline - unless the `with` block is already
+        # raising, in which case don't mask the original exception.
+        background_error = self._background_error
+        self._background_error = None
+        if background_error is not None and exc_type is None:
+            raise background_error
 
 
 __all__ = [
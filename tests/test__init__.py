@@ -1,9 +1,14 @@
 import capsql as _capsql
+import logging
 import pytest
 import sqlalchemy
 import sqlalchemy.ext.asyncio
 import sqlalchemy.ext.declarative
+import sqlparse
+import threading
+import weakref
 from textwrap import dedent
+from textwrap import indent
 
 _Base = sqlalchemy.orm.declarative_base()
 
@@ -43,9 +48,13 @@ async def test__init(engine):
     assert capsql.echo is False
     assert capsql.log is False
     assert capsql.show_params is False
+    assert capsql.logger is _capsql.logger
+    assert _capsql.logger.level == logging.NOTSET
     assert capsql.pretty is True
     assert isinstance(capsql.elements, list)
     assert isinstance(capsql.statements, list)
+    assert not hasattr(capsql, '__dict__')
+    assert weakref.ref(capsql)() is capsql
 
 
 class Test__capture:
@@ -107,3 +116,412 @@ class Test__capture:
         assert capsql.statements == expected_statements
         expected_text = '\n\n'.join(expected_statements)
         assert capsql.text == expected_text
+
+    async def test__text_cache(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        expr = sqlalchemy.select(User).filter_by(name=faker.name())
+
+        with capsql:
+            (await session.scalars(expr)).all()
+        text = capsql.text
+        assert text is capsql.text
+
+        with capsql:
+            (await session.scalars(expr)).all()
+        assert capsql.text is not text
+        assert capsql.text == '\n\n'.join([text, text])
+
+        capsql.clear()
+        assert capsql.text == ''
+
+    async def test__statements_copy(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind)
+
+        with capsql:
+            for _ in range(2):
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+        statements = capsql.statements
+        text = capsql.text
+        capsql.statements.clear()
+
+        assert capsql.statements == statements
+        assert capsql.statements is not statements
+        assert capsql.text == text
+
+    async def test__settings_snapshot(self, session):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        expr = sqlalchemy.select(User.id).filter_by(name='a')
+        statement = dedent(
+            '''
+            SELECT users.id
+            FROM users
+            WHERE users.name = ?
+            '''
+        ).strip()
+
+        with capsql:
+            (await session.scalars(expr)).all()
+        capsql.show_params = True
+        with capsql:
+            (await session.scalars(expr)).all()
+        capsql.show_params = False
+        capsql.pretty = False
+
+        assert capsql.statements == [
+            statement,
+            f"{statement}\n-- params: ('a',)",
+        ]
+        assert capsql.text == '\n\n'.join(capsql.statements)
+
+    async def test__echo(self, session, faker, capsys):
+        capsql = _capsql.CapSQL(engine=session.bind, echo=True)
+        _capsql._get_sql_lexer.cache_clear()
+        _capsql._get_terminal_formatter.cache_clear()
+        _capsql._colorize.cache_clear()
+
+        with capsql:
+            for _ in range(2):
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+            expr = sqlalchemy.select(User).filter_by(email=faker.email())
+            (await session.scalars(expr)).all()
+
+        captured = capsys.readouterr()
+        assert captured.out == ''
+        assert captured.err.count('\x1b[') > 0
+        assert captured.err.count('FROM') == 3
+        assert _capsql._colorize.cache_info().misses == 2
+        assert _capsql._colorize.cache_info().hits == 1
+        assert _capsql._get_sql_lexer.cache_info().misses == 1
+        assert _capsql._get_sql_lexer.cache_info().hits == 1
+        assert _capsql._get_terminal_formatter.cache_info().misses == 1
+        assert _capsql._get_terminal_formatter.cache_info().hits == 1
+
+    async def test__echo_show_params(self, session, capsys):
+        capsql = _capsql.CapSQL(engine=session.bind, echo=True, show_params=True)
+        _capsql._colorize.cache_clear()
+
+        with capsql:
+            for name in ['a', 'b']:
+                expr = sqlalchemy.select(User).filter_by(name=name)
+                (await session.scalars(expr)).all()
+
+        # Params vary between executions, so only the SQL itself should be cached:
+        assert _capsql._colorize.cache_info().misses == 1
+        assert _capsql._colorize.cache_info().hits == 1
+        err = capsys.readouterr().err
+        assert "'a'" in err
+        assert "'b'" in err
+
+    async def test__echo_max_format_bytes(self, session, faker, capsys):
+        capsql = _capsql.CapSQL(engine=session.bind, echo=True, max_format_bytes=32)
+        _capsql._colorize.cache_clear()
+
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+
+        assert capsys.readouterr().err == capsql.statements[0] + '\n'
+        assert _capsql._colorize.cache_info().misses == 0
+
+    async def test__repeated_statement(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        _capsql._format_sql.cache_clear()
+
+        with capsql:
+            for _ in range(3):
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+
+        assert len(capsql.statements) == 3
+        assert len(set(capsql.statements)) == 1
+        cache_info = _capsql._format_sql.cache_info()
+        assert cache_info.misses == 1
+        assert cache_info.hits == 2
+
+    async def test__lazy_formatting(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        _capsql._format_sql.cache_clear()
+
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+
+        assert len(capsql.elements) == 1
+        assert _capsql._format_sql.cache_info().misses == 0
+        assert capsql.statements[0].startswith('SELECT users.id,\n')
+        assert capsql.text == capsql.statements[0]
+        assert _capsql._format_sql.cache_info().misses == 1
+        assert _capsql._format_sql.cache_info().hits == 0
+
+        capsql.clear()
+        assert capsql.elements == []
+        assert capsql.statements == []
+        assert capsql.text == ''
+
+    async def test__max_format_bytes(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind, max_format_bytes=32)
+
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+
+        raw_statement = (
+            'SELECT users.id, users.name, users.email \nFROM users \n'
+            'WHERE users.name = ?'
+        )
+        assert capsql.statements == [
+            f'{raw_statement}\n'
+            f'-- [capsql: skipped pretty-printing, {len(raw_statement)} bytes]'
+        ]
+
+    async def test__buffered_echo(self, session, faker, capsys):
+        capsql = _capsql.CapSQL(
+            engine=session.bind, echo=True, color=False, flush=False
+        )
+
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+            assert capsys.readouterr().err == ''
+
+        assert capsys.readouterr().err == capsql.statements[0] + '\n'
+
+    async def test__log(self, session, faker, caplog):
+        capsql = _capsql.CapSQL(engine=session.bind, log=True, color=False)
+
+        with caplog.at_level(logging.INFO, logger=_capsql.logger.name):
+            with capsql:
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+
+        assert caplog.messages == ['\n' + indent(capsql.statements[0], '    ')]
+
+    async def test__clear(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        expr = sqlalchemy.select(User).filter_by(name=faker.name())
+
+        with capsql:
+            (await session.scalars(expr)).all()
+            elements = capsql.elements
+            capsql.clear()
+            (await session.scalars(expr)).all()
+
+        assert capsql.elements is elements
+        assert len(capsql.elements) == 1
+        assert len(capsql.statements) == 1
+
+    async def test__max_captured(self, session):
+        capsql = _capsql.CapSQL(engine=session.bind, max_captured=2)
+
+        with capsql:
+            for name in ['a', 'b', 'c']:
+                expr = sqlalchemy.select(User).filter_by(name=name)
+                (await session.scalars(expr)).all()
+            assert len(capsql.statements) == 2
+            (await session.scalars(expr)).all()
+
+        assert len(capsql.elements) == 2
+        assert len(capsql.statements) == 2
+        assert capsql.elements[0].whereclause.right.value == 'c'
+
+    @pytest.mark.parametrize('capture_elements', [True, False, 'weak'])
+    @pytest.mark.parametrize('capture_statements', [True, False])
+    async def test__capture_flags(
+        self, session, faker, capture_elements, capture_statements
+    ):
+        capsql = _capsql.CapSQL(
+            engine=session.bind,
+            capture_elements=capture_elements,
+            capture_statements=capture_statements,
+        )
+
+        dispatch = session.bind.sync_engine.dispatch
+
+        with capsql:
+            assert len(dispatch.before_execute) == (1 if capture_elements else 0)
+            assert len(dispatch.before_cursor_execute) == (
+                1 if capture_statements else 0
+            )
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+
+        assert len(capsql.elements) == (1 if capture_elements else 0)
+        assert len(capsql.statements) == (1 if capture_statements else 0)
+        assert len(dispatch.before_execute) == 0
+        assert len(dispatch.before_cursor_execute) == 0
+
+    async def test__text_max_captured(self, session):
+        capsql = _capsql.CapSQL(engine=session.bind, max_captured=2)
+
+        with capsql:
+            for name in ['a', 'b', 'c']:
+                expr = sqlalchemy.select(User).filter_by(name=name)
+                (await session.scalars(expr)).all()
+            assert capsql.text == '\n\n'.join(capsql.statements)
+            (await session.execute(sqlalchemy.text('SELECT 1'))).all()
+
+        assert len(capsql.statements) == 2
+        assert capsql.text == '\n\n'.join(capsql.statements)
+        assert capsql.text.endswith('SELECT 1')
+
+    async def test__text_polling(self, session):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        _capsql._format_sql.cache_clear()
+        num_statements = 20
+
+        with capsql:
+            for i in range(num_statements):
+                (await session.execute(sqlalchemy.text(f'SELECT {i}'))).all()
+                assert capsql.text.endswith(f'SELECT {i}')
+
+        # Each statement should only have been formatted once:
+        cache_info = _capsql._format_sql.cache_info()
+        assert cache_info.misses == num_statements
+        assert cache_info.hits == 0
+        assert len(capsql.statements) == num_statements
+
+    async def test__background_echo(self, session, faker, capsys):
+        capsql = _capsql.CapSQL(
+            engine=session.bind, echo=True, color=False, background=True
+        )
+
+        with capsql:
+            for _ in range(3):
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+
+        assert not any(
+            thread.name.startswith('capsql') for thread in threading.enumerate()
+        )
+        assert capsys.readouterr().err == ''.join(
+            f'{statement}\n' for statement in capsql.statements
+        )
+
+    async def test__max_params_repr(self, session, faker):
+        capsql = _capsql.CapSQL(
+            engine=session.bind, show_params=True, max_params_repr=1
+        )
+
+        with capsql:
+            async with session.begin():
+                session.add(User(name=faker.name(), email=faker.email()))
+
+        assert capsql.statements == [
+            dedent(
+                '''
+                INSERT INTO users (name, email)
+                VALUES (?, ?)
+                -- params: <2 items truncated>
+                '''
+            ).strip(),
+        ]
+
+    async def test__already_pretty(self, session):
+        capsql = _capsql.CapSQL(engine=session.bind)
+        statement = dedent(
+            '''
+            SELECT users.name
+            FROM users
+            WHERE users.id = 1
+            '''
+        ).strip()
+        _capsql._format_sql.cache_clear()
+
+        with capsql:
+            (await session.execute(sqlalchemy.text(statement))).all()
+
+        assert capsql.statements == [statement]
+        assert _capsql._format_sql.cache_info().misses == 0
+
+    async def test__log_disabled(self, session, faker, caplog):
+        capsql = _capsql.CapSQL(engine=session.bind, log=True)
+        _capsql._format_sql.cache_clear()
+        _capsql._colorize.cache_clear()
+
+        with caplog.at_level(logging.WARNING, logger=_capsql.logger.name):
+            with capsql:
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+
+        assert caplog.messages == []
+        assert _capsql._format_sql.cache_info().misses == 0
+        assert _capsql._colorize.cache_info().misses == 0
+        assert len(capsql.statements) == 1
+
+    async def test__log_level_changed_in_context(self, session, faker, caplog):
+        capsql = _capsql.CapSQL(engine=session.bind, log=True, color=False)
+        caplog.set_level(logging.WARNING, logger=_capsql.logger.name)
+
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+            caplog.set_level(logging.INFO, logger=_capsql.logger.name)
+            (await session.scalars(expr)).all()
+
+        assert caplog.messages == ['\n' + indent(capsql.statements[1], '    ')]
+
+    async def test__weak_elements(self, session, faker):
+        capsql = _capsql.CapSQL(engine=session.bind, capture_elements='weak')
+        expr = sqlalchemy.select(User).filter_by(name=faker.name())
+
+        with capsql:
+            (await session.scalars(expr)).all()
+
+        (element_ref,) = capsql.elements
+        assert isinstance(element_ref, weakref.ref)
+        assert element_ref() is expr
+
+    @pytest.mark.parametrize('background', [False, True])
+    async def test__output_error(self, session, faker, monkeypatch, background):
+        capsql = _capsql.CapSQL(engine=session.bind, echo=True, background=background)
+        sync_engine = session.bind.sync_engine
+
+        def _format_sql(statement):
+            raise ValueError('oops')
+
+        monkeypatch.setattr(_capsql, '_format_sql', _format_sql)
+
+        with pytest.raises(ValueError, match='oops'):
+            with capsql:
+                for _ in range(2):
+                    expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                    (await session.scalars(expr)).all()
+
+        assert len(sync_engine.dispatch.before_execute) == 0
+        assert len(sync_engine.dispatch.before_cursor_execute) == 0
+
+        # The error shouldn't linger around to be raised by a later capture:
+        monkeypatch.undo()
+        with capsql:
+            expr = sqlalchemy.select(User).filter_by(name=faker.name())
+            (await session.scalars(expr)).all()
+
+    async def test__background_error_doesnt_mask(self, session, faker, monkeypatch):
+        capsql = _capsql.CapSQL(engine=session.bind, echo=True, background=True)
+
+        def _format_sql(statement):
+            raise ValueError('oops')
+
+        monkeypatch.setattr(_capsql, '_format_sql', _format_sql)
+
+        with pytest.raises(KeyError):
+            with capsql:
+                expr = sqlalchemy.select(User).filter_by(name=faker.name())
+                (await session.scalars(expr)).all()
+                raise KeyError()
+
+
+
+@pytest.mark.parametrize(
+    'statement',
+    [
+        'SELECT users.id, users.name \nFROM users \nWHERE users.name = ?',
+        'INSERT INTO users (name, email) VALUES (?, ?)',
+        'select a, b from t where x = 1; select 1',
+    ],
+)
+def test__format_sql(statement):
+    expected = sqlparse.format(statement, reindent=True)
+    assert _capsql._format_sql(statement) == expected